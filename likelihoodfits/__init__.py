@@ -1,2 +1,2 @@
-from .classes import Axis, LikelihoodResults, LikelihoodValues
+from .classes import Axis, LikelihoodResults, LikelihoodValues, rowwise
 from . import plot
@@ -1,13 +1,123 @@
-from math import isinf
+import math
+from functools import lru_cache
+from operator import attrgetter
 from typing import Callable
-from collections.abc import Sequence
+from collections.abc import Iterator, Sequence
 from dataclasses import dataclass, field
 from itertools import product
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 from io import BytesIO
 import h5py
 
 LikelihoodFunction = Callable[[float, float], dict[str, float]]
+VectorizedLikelihoodFunction = Callable[[np.ndarray, np.ndarray],
+                                        dict[str, np.ndarray]]
+RowLikelihoodFunction = Callable[[float, np.ndarray], dict[str, np.ndarray]]
+
+
+def rowwise(fun: LikelihoodFunction) -> RowLikelihoodFunction:
+    """Adapts a function that calculates the likelihoods at one point
+    to be used with `LikelihoodResults.calculate_all_batched`, for
+    backends (e.g. smelli) without a batched interface
+
+    Arguments
+    ---------
+        fun (Function(float, float) -> dict[str, float]):
+        Function that calculates the likelihoods at each point
+
+    Returns
+    -------
+        Function(float, np.ndarray) -> dict[str, np.ndarray]:
+        Function that calculates the likelihoods at one x and all the
+        given values of y, calling `fun` at each of them. It raises
+        `ValueError` if `fun` does not return the same likelihoods at
+        every point
+    """
+    def fun_row(x: float, ys: np.ndarray) -> dict[str, np.ndarray]:
+        rows: dict[str, np.ndarray] = {}
+        for iy, y in enumerate(ys.tolist()):
+            point = fun(x, y)
+            if iy == 0:
+                rows = {k: np.empty(len(ys)) for k in point}
+            elif point.keys() != rows.keys():
+                raise ValueError(f'The likelihoods returned at ({x}, {y}) '
+                                 'differ from those at the other points')
+            for k, v in point.items():
+                rows[k][iy] = v
+        return rows
+    return fun_row
+
+
+_worker_fun: LikelihoodFunction | None = None
+
+
+def _init_worker(fun: LikelihoodFunction) -> None:
+    """Stores `fun` in a worker process, so that it is sent only once
+    per worker instead of once per point.
+    """
+    global _worker_fun
+    _worker_fun = fun
+
+
+def _eval_point(ix: int, iy: int,
+                x: float, y: float) -> tuple[int, int, dict[str, float]]:
+    """Evaluates the function of the worker process at one point of the
+    grid, keeping track of its indices. Defined at module level so that
+    it can be pickled and sent to the worker processes.
+    """
+    return ix, iy, _worker_fun(x, y)
+
+
+def _clamp_inf(arr: np.ndarray) -> np.ndarray:
+    """Replaces, in place, the infinite log-likelihoods by -200.0
+    """
+    return np.nan_to_num(arr, copy=False, nan=np.nan,
+                         posinf=-200.0, neginf=-200.0)
+
+
+def _chunk_heuristic(shape: tuple[int, ...], itemsize: int = 4,
+                     target: int = 128*1024) -> tuple[int, ...]:
+    """Chooses the shape of the HDF5 chunks: the whole dataset if it fits
+    in `target` bytes, otherwise it is halved along each axis in turn until
+    it does.
+    """
+    chunks = list(shape)
+    axis = 0
+    while np.prod(chunks)*itemsize > target and max(chunks) > 1:
+        chunks[axis] = -(-chunks[axis] // 2)
+        axis = (axis + 1) % len(chunks)
+    return tuple(chunks)
+
+
+def _read_f4(dset: h5py.Dataset) -> np.ndarray:
+    """Reads a dataset directly into a new `float32` array
+    """
+    data = np.empty(dset.shape, dtype='f4')
+    if data.size:
+        dset.read_direct(data)
+    return data
+
+
+@lru_cache(maxsize=None)
+def _numba_filler(jitted_fun: Callable) -> Callable:
+    """Compiles the kernel that fills the stacked likelihood grids
+    with `jitted_fun`. Cached, so that each function is only compiled once.
+    """
+    import numba
+
+    # `fastmath=True` would assume that there are no infinities,
+    # so the flags that allow that assumption are left out
+    @numba.njit(parallel=True,
+                fastmath={'nsz', 'arcp', 'contract', 'afn', 'reassoc'})
+    def _fill(xs, ys, out):
+        for iy in numba.prange(ys.size):
+            for ix in range(xs.size):
+                vals = jitted_fun(xs[ix], ys[iy])
+                for k in range(out.shape[0]):
+                    v = vals[k]
+                    out[k, iy, ix] = -200.0 if math.isinf(v) else v
+    return _fill
 
 
 @dataclass
@@ -17,7 +127,7 @@ class Axis:
     Arguments
     ---------
         ticks (`Sequence[float]`): Points at which the likelihood will 
-        be computed
+        be computed. Stored as a read-only `float32` array
 
         name (`str`): Name of the axis
 
@@ -28,26 +138,47 @@ class Axis:
     name: str
     tex_label: str
 
+    def __setattr__(self, name, value):
+        if name == 'ticks':
+            # The ticks are copied and frozen, and the cached values are
+            # recomputed every time they are assigned
+            value = np.array(value, dtype='f4', order='C')
+            value.flags.writeable = False
+            self._len = value.size
+            if self._len:
+                self._min = float(value.min())
+                self._max = float(value.max())
+            else:
+                self._min = self._max = float('nan')
+        super().__setattr__(name, value)
+
+    def __eq__(self, other):
+        if not isinstance(other, Axis):
+            return NotImplemented
+        return (np.array_equal(self.ticks, other.ticks)
+                and self.name == other.name
+                and self.tex_label == other.tex_label)
+
     @property
     def len(self) -> int:
         """Length of the axis
         """
-        return len(self.ticks)
+        return self._len
 
     @property
     def min(self) -> float:
         """Minimum of the axis
         """
-        return min(self.ticks)
+        return self._min
 
     @property
     def max(self) -> float:
         """Maximum of the axis
         """
-        return max(self.ticks)
+        return self._max
 
     def __getitem__(self, item: int) -> float:
-        return self.ticks[item]
+        return float(self.ticks[item])
 
 
 @dataclass
@@ -56,7 +187,8 @@ class LikelihoodValues:
 
     Arguments
     ---------
-        data (`np.ndarray`): Grid of log-likelihood values
+        data (`np.ndarray`): Grid of log-likelihood values, with shape
+        `(y.len, x.len)`, i.e. `data[iy, ix]`
 
         likelihood (`str`): Name of the likelihood used by smelli
 
@@ -71,6 +203,10 @@ class LikelihoodValues:
     likelihood: str
     tex_label: str
     order: int = field(kw_only=True, default=0)
+    _cached_max: float = field(init=False, repr=False, compare=False,
+                               default=0.0)
+    _max_dirty: bool = field(init=False, repr=False, compare=False,
+                             default=True)
 
     @property
     def shape(self) -> tuple[int, int]:
@@ -84,9 +220,42 @@ class LikelihoodValues:
 
     @property
     def max(self) -> float:
-        """Maximum likelihood
+        """Maximum likelihood. It is cached, and kept up to date by
+        `update`. After writing directly to `data`, call `invalidate_max`
         """
-        return np.max(self.data)
+        if self._max_dirty:
+            self._cached_max = np.max(self.data)
+            self._max_dirty = False
+        return self._cached_max
+
+    def invalidate_max(self) -> None:
+        """Forces the maximum to be recomputed on the next access
+        """
+        self._max_dirty = True
+
+    def update(self, iy: int, ix: int, val: float) -> None:
+        """Sets the log-likelihood at one point, updating the maximum
+
+        Arguments
+        ---------
+            iy (int): y-index of the point
+
+            ix (int): x-index of the point
+
+            val (float): New value of the log-likelihood
+        """
+        old = self.data[iy, ix]
+        self.data[iy, ix] = val
+        self._track_max(old, self.data[iy, ix])
+
+    def _track_max(self, old: float, new: float) -> None:
+        if self._max_dirty:
+            return
+        if new > self._cached_max:
+            self._cached_max = new
+        # Overwriting the maximum (or any NaN) requires a full rescan
+        elif not (new <= self._cached_max and old < self._cached_max):
+            self._max_dirty = True
 
 
 @dataclass
@@ -100,13 +269,58 @@ class LikelihoodResults:
     y (`Axis`): y-axis
 
     likelihoods (`list[LikelihoodValues]`, initialized to `[]`):
-    List of likelihood values 
+    List of likelihood values. The data of all the likelihoods is stored
+    contiguously in a single array, see `values`
     """
 
     x: Axis
     y: Axis
     likelihoods: list[LikelihoodValues] = field(
         init=False, default_factory=list)
+    _stack: np.ndarray = field(init=False, repr=False, compare=False)
+    _zoom_cache: dict[float, tuple[np.ndarray, ...]] = field(
+        init=False, repr=False, compare=False, default_factory=dict)
+
+    def __post_init__(self):
+        self._stack = np.zeros((0, self.y.len, self.x.len), dtype='f4')
+
+    @property
+    def values(self) -> np.ndarray:
+        """Log-likelihood values of all the likelihoods
+
+        Returns
+        -------
+            np.ndarray: Array of shape `(len(likelihoods), *data shape)`.
+            `values[i]` shares memory with `likelihoods[i].data`
+        """
+        if not self._stack_in_sync():
+            self._restack()
+        return self._stack
+
+    def _stack_in_sync(self) -> bool:
+        return len(self._stack) == len(self.likelihoods) and all(
+            l.data.base is self._stack
+            and l.data.ctypes.data == data.ctypes.data
+            for l, data in zip(self.likelihoods, self._stack))
+
+    def _restack(self) -> None:
+        if self.likelihoods:
+            self._stack = np.stack([np.asarray(l.data, dtype='f4')
+                                    for l in self.likelihoods])
+        else:
+            self._stack = np.zeros((0,) + self._stack.shape[1:], dtype='f4')
+        self._link_stack()
+
+    def _link_stack(self) -> None:
+        for l, data in zip(self.likelihoods, self._stack):
+            l.data = data
+            l.invalidate_max()
+
+    def _extend_stack(self, lh: LikelihoodValues) -> None:
+        self._stack = np.concatenate(
+            [self.values, np.asarray(lh.data, dtype='f4')[np.newaxis]])
+        self.likelihoods.append(lh)
+        self._link_stack()
 
     @property
     def numdata(self) -> int:
@@ -119,7 +333,8 @@ class LikelihoodResults:
         return self.x.len * self.y.len
 
     def add_likelihood(self, lh: LikelihoodValues) -> None:
-        """Adds an already-calculated likelihood
+        """Adds an already-calculated likelihood. Its data is copied
+        into the storage shared by all the likelihoods
 
         Arguments
         ---------
@@ -131,20 +346,34 @@ class LikelihoodResults:
             The dimension of the data and the axis do not match
         """
 
-        if lh.shape[0] != self.x.len:
-            raise ValueError(
-                "The dimension of the data and the axis do not match along the x direction")
-        if lh.shape[1] != self.y.len:
+        if lh.shape[0] != self.y.len:
             raise ValueError(
                 "The dimension of the data and the axis do not match along the y direction")
-        self.likelihoods.append(lh)
+        if lh.shape[1] != self.x.len:
+            raise ValueError(
+                "The dimension of the data and the axis do not match along the x direction")
+        self._extend_stack(lh)
 
-    def to_hdf5(self, path: str | BytesIO) -> None:
+    def to_hdf5(self, path: str | BytesIO, *,
+                compression: str | None = 'lzf',
+                lsd: int | None = 3) -> None:
         """Saves to an HDF5 file
 
         Arguments
         ----------
             path (str): Path to the HDF5 file
+
+            compression (str, optional): HDF5 compression filter for the
+            likelihood values, e.g. `'lzf'` (default, fast) or `'gzip'`
+            (smaller files). `None` disables the compression
+
+            lsd (int, optional): Least significant digit. The likelihood
+            values are quantized before saving, keeping at least `lsd`
+            decimal places. The values are rounded to a multiple of a
+            power of two (as netCDF's `least_significant_digit`
+            does), so the trailing mantissa bits are zero. This improves
+            the compression with no visible effect on the contours.
+            `None` saves the values without rounding
         """
         with h5py.File(path, 'w') as f:
             axes = f.create_group('axes')
@@ -155,10 +384,26 @@ class LikelihoodResults:
                                'y name': self.y.name,
                                'y tex': self.y.tex_label})
             likelihoods = f.create_group('likelihoods')
-            for l in self.likelihoods:
-                gr = likelihoods.create_group(l.likelihood)
-                gr.attrs.update({'tex': l.tex_label, 'order': l.order})
-                gr.create_dataset('values', data=l.data, dtype='f4')
+            values = self.values
+            if lsd is not None:
+                # A power-of-two scale zeroes the trailing mantissa bits,
+                # unlike rounding to decimal places
+                scale = 2.0**math.ceil(math.log2(10.0**lsd))
+                values = (np.around(values*scale)/scale).astype('f4')
+            chunks = _chunk_heuristic(values.shape) if values.size else True
+            ds = likelihoods.create_dataset('values', data=values, dtype='f4',
+                                            chunks=chunks, shuffle=True,
+                                            compression=compression)
+            if lsd is not None:
+                ds.attrs['least_significant_digit'] = lsd
+            likelihoods.create_dataset(
+                'names', data=[l.likelihood for l in self.likelihoods],
+                dtype=h5py.string_dtype())
+            likelihoods.create_dataset(
+                'tex', data=[l.tex_label for l in self.likelihoods],
+                dtype=h5py.string_dtype())
+            likelihoods.create_dataset(
+                'order', data=[l.order for l in self.likelihoods], dtype='i8')
 
     @classmethod
     def from_hdf5(cls, path: str | BytesIO):
@@ -173,22 +418,45 @@ class LikelihoodResults:
             LikelihoodResults: Loaded data
         """
 
-        with h5py.File(path, 'r') as f:
-            xdata = np.array(f['axes']['x'], dtype='f4')
+        with h5py.File(path, 'r', rdcc_nbytes=16*1024*1024) as f:
+            xdata = _read_f4(f['axes']['x'])
             x = Axis(xdata, f['axes'].attrs['x name'],
                      f['axes'].attrs['x tex'])
-            ydata = np.array(f['axes']['y'], dtype='f4')
+            ydata = _read_f4(f['axes']['y'])
             y = Axis(ydata, f['axes'].attrs['y name'],
                      f['axes'].attrs['y tex'])
             results = LikelihoodResults(x, y)
+            if isinstance(f['likelihoods'].get('values'), h5py.Dataset):
+                cls._read_likelihoods(f['likelihoods'], results)
+                return results
+            # Files written by older versions, with a group per likelihood
             for k in f['likelihoods'].keys():
-                data = np.array(f['likelihoods'][k]['values'], dtype='f4')
+                data = _read_f4(f['likelihoods'][k]['values'])
                 lh = LikelihoodValues(
                     data, k, f['likelihoods'][k].attrs['tex'], order=f['likelihoods'][k].attrs['order'])
                 results.add_likelihood(lh)
-                results.likelihoods.sort(key=lambda x: x.order)
+            results.likelihoods.sort(key=attrgetter('order'))
         return results
 
+    @staticmethod
+    def _read_likelihoods(group: h5py.Group,
+                          results: 'LikelihoodResults') -> None:
+        values = _read_f4(group['values'])
+        if values.shape[1:] != results._stack.shape[1:]:
+            raise ValueError(
+                "The dimension of the data and the axis do not match")
+        names = group['names'].asstr()[()]
+        texs = group['tex'].asstr()[()]
+        orders = group['order'][()]
+        # The values are adopted as the shared array, in plotting order
+        perm = np.argsort(orders, kind='stable')
+        if np.any(perm != np.arange(len(perm))):
+            values = values[perm]
+        results._stack = values
+        results.likelihoods = [
+            LikelihoodValues(values[i], names[j], texs[j], order=int(orders[j]))
+            for i, j in enumerate(perm)]
+
     def new_likelihood(self, likelihood: str, tex_label: str) -> None:
         """Creates a new empty likelihood
 
@@ -200,10 +468,10 @@ class LikelihoodResults:
             the likelihood
         """
 
-        lh = LikelihoodValues(np.zeros((self.x.len, self.y.len), dtype='f4'),
+        lh = LikelihoodValues(np.zeros((self.y.len, self.x.len), dtype='f4'),
                               likelihood, tex_label,
                               order=len(self.likelihoods))
-        self.likelihoods.append(lh)
+        self._extend_stack(lh)
 
     def calculate_point(self, fun: LikelihoodFunction, ix: int, iy: int):
         """Calculates the likelihoods at one point of the grid
@@ -223,13 +491,189 @@ class LikelihoodResults:
         """
         x = self.x[ix]
         y = self.y[iy]
-        lhdict = fun(x, y)
-        for l in self.likelihoods:
-            lval = lhdict[l.likelihood]
-            if isinf(lval):
-                lval = -200.0
-            l.data[iy, ix] = lval
+        self._store_point(fun(x, y), ix, iy)
+
+    def _store_point(self, lhdict: dict[str, float], ix: int, iy: int):
+        lvals = np.array([lhdict[l.likelihood] for l in self.likelihoods],
+                         dtype='f4')
+        _clamp_inf(lvals)
+        olds = self.values[:, iy, ix].copy()
+        self.values[:, iy, ix] = lvals
+        for l, old, new in zip(self.likelihoods, olds, lvals):
+            l._track_max(old, new)
 
     def calculate_all(self, fun: LikelihoodFunction):
-        for ix, iy in product(range(self.x.len), range(self.y.len)):
-            self.calculate_point(fun, ix, iy)
+        """Calculates the likelihoods at all the points of the grid
+
+        Arguments
+        ---------
+            fun (Function(float, float) -> dict[str, float]):
+            Function that calculates the likelihoods at each point,
+            as in `calculate_point`.
+        """
+        xs = self.x.ticks.tolist()
+        ys = self.y.ticks.tolist()
+        names = [l.likelihood for l in self.likelihoods]
+        values = self.values
+        # The maxima are invalidated before writing, in case `fun` raises
+        # after some columns have already been overwritten
+        for l in self.likelihoods:
+            l.invalidate_max()
+        # The points are calculated column by column (fixed x), and each
+        # column is clamped and stored at once
+        column = np.empty((len(names), len(ys)), dtype='f4')
+        for ix, xv in enumerate(xs):
+            for iy, yv in enumerate(ys):
+                lhdict = fun(xv, yv)
+                column[:, iy] = [lhdict[name] for name in names]
+            values[:, :, ix] = _clamp_inf(column)
+
+    def calculate_all_batched(self, fun_row: RowLikelihoodFunction):
+        """Calculates the likelihoods at all the points of the grid,
+        one column (fixed x) per call
+
+        Arguments
+        ---------
+            fun_row (Function(float, np.ndarray) -> dict[str, np.ndarray]):
+            Function that calculates the likelihoods at one value of x
+            and all the values of y in `y.ticks`, and returns a
+            dictionary with the likelihood names and arrays of values,
+            so that `fun_row(x, ys)[name][iy]` is the value at
+            `(x, ys[iy])`. The likelihood names must be the same as in
+            the definition of the LikelihoodValues objects.
+            Functions that calculate one point at a time, as in
+            `calculate_point`, can be adapted with `rowwise`.
+        """
+        ys = np.array(self.y.ticks)
+        values = self.values
+        for l in self.likelihoods:
+            l.invalidate_max()
+        for ix in range(self.x.len):
+            rows = fun_row(self.x[ix], ys)
+            for i, l in enumerate(self.likelihoods):
+                row = np.array(rows[l.likelihood], dtype='f4')
+                values[i, :, ix] = _clamp_inf(row)
+
+    def calculate_all_parallel(self, fun: LikelihoodFunction,
+                               nworkers: int | None = None
+                               ) -> Iterator[tuple[int, int]]:
+        """Calculates the likelihoods at all the points of the grid,
+        distributing the points among several processes
+
+        This is a generator: the grid is only filled while it is being
+        iterated, and the indices of each point are yielded as soon as
+        it has been calculated, so that the progress can be tracked.
+
+        Arguments
+        ---------
+            fun (Function(float, float) -> dict[str, float]):
+            Function that calculates the likelihoods at each point,
+            as in `calculate_point`. It must be picklable (i.e. defined
+            at the top level of a module, not a lambda). It is sent
+            only once to each worker process.
+
+            nworkers (int, optional): Number of worker processes.
+            Defaults to the number of processors of the machine.
+            If `nworkers=1`, the points are calculated serially in
+            the current process.
+
+        Notes
+        -----
+            The worker processes are forked. If `calculate_all_numba` (or
+            any other parallel numba code) runs in the same program, set
+            `NUMBA_THREADING_LAYER=forksafe` (or `safe`), so that numba
+            uses a threading layer that survives the fork.
+
+        Yields
+        ------
+            tuple[int, int]: x- and y-indices of the calculated point
+        """
+        points = product(range(self.x.len), range(self.y.len))
+        if nworkers == 1:
+            for ix, iy in points:
+                self.calculate_point(fun, ix, iy)
+                yield ix, iy
+            return
+        pool = ProcessPoolExecutor(max_workers=nworkers,
+                                   initializer=_init_worker, initargs=(fun,))
+        try:
+            futures = [pool.submit(_eval_point, ix, iy,
+                                   self.x[ix], self.y[iy])
+                       for ix, iy in points]
+            for future in as_completed(futures):
+                ix, iy, lhdict = future.result()
+                self._store_point(lhdict, ix, iy)
+                yield ix, iy
+        finally:
+            # If the iteration is interrupted, the pending points are
+            # discarded instead of waiting for them
+            pool.shutdown(cancel_futures=True)
+
+    def calculate_all_vectorized(self, fun: VectorizedLikelihoodFunction):
+        """Calculates the likelihoods at all the points of the grid
+        with a single call to a vectorized function
+
+        Arguments
+        ---------
+            fun (Function(np.ndarray, np.ndarray) -> dict[str, np.ndarray]):
+            Function that calculates the likelihoods over the whole grid.
+            It is called once with two 2D arrays `X` and `Y` of shape
+            `(y.len, x.len)`, as returned by `np.meshgrid(x.ticks, y.ticks)`,
+            and must return a dictionary with the likelihood names and
+            arrays of values broadcastable to that same shape, so that
+            `fun(X, Y)[name][iy, ix]` is the value at `(x[ix], y[iy])`.
+            The likelihood names must be the same as in the definition
+            of the LikelihoodValues objects.
+            Functions that only accept scalars should be used with
+            `calculate_all` or `calculate_point` instead.
+        """
+        X, Y = np.meshgrid(self.x.ticks, self.y.ticks, indexing='xy')
+        lhdict = fun(X, Y)
+        for l in self.likelihoods:
+            arr = np.array(lhdict[l.likelihood], dtype='f4')
+            l.invalidate_max()
+            l.data[:, :] = _clamp_inf(arr)
+
+    def calculate_all_numba(self, jitted_fun: Callable):
+        """Calculates the likelihoods at all the points of the grid
+        with a compiled, multithreaded loop. Requires `numba`.
+
+        Arguments
+        ---------
+            jitted_fun (Function(float, float) -> tuple[float, ...]):
+            Function decorated with `@numba.njit`, that calculates the
+            likelihoods at each point and returns a tuple (or 1D array)
+            with one value for each likelihood, in the same order as
+            `self.likelihoods`. Since it is called from compiled code,
+            it must only use features supported by numba's nopython
+            mode.
+
+        Notes
+        -----
+            The threads are managed by numba's threading layer, which is
+            not changed here. Not every layer is fork-safe, so in programs
+            that also use `calculate_all_parallel` (which forks worker
+            processes), set the environment variable
+            `NUMBA_THREADING_LAYER=forksafe` (or `safe`) before the first
+            parallel numba call.
+
+        Raises
+        ------
+            ValueError:
+            The number of values returned by `jitted_fun` and the
+            number of likelihoods do not match
+        """
+        fill = _numba_filler(jitted_fun)
+        xs = np.asarray(self.x.ticks, dtype='f8')
+        ys = np.asarray(self.y.ticks, dtype='f8')
+        if xs.size and ys.size:
+            # The compiled loop can not report a wrong number of values
+            # clearly, so it is checked once before
+            nvals = len(jitted_fun(xs[0], ys[0]))
+            if nvals != len(self.likelihoods):
+                raise ValueError(
+                    f"The function returns {nvals} values, but there "
+                    f"are {len(self.likelihoods)} likelihoods")
+        for l in self.likelihoods:
+            l.invalidate_max()
+        fill(xs, ys, self.values)
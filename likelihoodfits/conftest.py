@@ -0,0 +1,7 @@
+import os
+
+# The plots are only drawn in memory during the tests
+os.environ.setdefault('MPLBACKEND', 'Agg')
+# The suite runs numba's parallel kernels and then forks process pools in
+# the same interpreter, so pin a threading layer that survives the fork
+os.environ.setdefault('NUMBA_THREADING_LAYER', 'workqueue')
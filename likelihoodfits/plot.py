@@ -1,17 +1,23 @@
 from typing import Sequence
+import math
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import scipy.stats
 import scipy.ndimage
+from scipy.interpolate import RectBivariateSpline
 import matplotlib.cm
 import matplotlib.pyplot as plt
-from likelihoodfits.classes import LikelihoodResults
+from likelihoodfits.classes import Axis, LikelihoodResults
 
 plt.rcParams.update({'pgf.texsystem': 'pdflatex'})
 ColorTuple = tuple[float, float, float]
 
 pastel: Sequence[ColorTuple] = matplotlib.cm.get_cmap('tab10').colors
+_PALETTE = np.asarray(pastel, dtype=np.float32)
 
 
+@lru_cache(maxsize=None)
 def delta_chi2(nsigma: float, dof: int) -> float:
     r"""Compute the $\Delta\chi^2$ for `dof` degrees of freedom corresponding
     to `nsigma` Gaussian standard deviations.
@@ -20,11 +26,43 @@ def delta_chi2(nsigma: float, dof: int) -> float:
     if dof == 1:
         # that's trivial
         return nsigma**2
+    if dof == 2:
+        # chi2(2).ppf(p) = -2 log(1-p), and 1-p = erfc(nsigma/sqrt(2))
+        tail = math.erfc(nsigma/math.sqrt(2))
+        if tail == 0.0:
+            return math.inf
+        return -2.0 * math.log(tail)
     chi2_ndof = scipy.stats.chi2(dof)
     cl_nsigma = (scipy.stats.norm.cdf(nsigma)-0.5)*2
     return chi2_ndof.ppf(cl_nsigma)
 
 
+def _sorted_ticks(axis: Axis) -> tuple[np.ndarray, np.ndarray]:
+    """Ticks of `axis` in increasing order, as needed by the spline
+    interpolation, and the permutation that sorts them
+    """
+    order = np.argsort(axis.ticks, kind='stable')
+    ticks = axis.ticks[order]
+    if np.any(np.diff(ticks) == 0):
+        raise ValueError(f"The ticks of the axis {axis.name} are not distinct")
+    return order, ticks
+
+
+def _zoomed_axes(lh: LikelihoodResults,
+                 zoom: float) -> tuple[np.ndarray, np.ndarray]:
+    """Fine x and y axes, in increasing order, used to interpolate the
+    likelihoods, cached in `lh` for each `zoom`. The cache is invalidated
+    if the ticks change.
+    """
+    cached = lh._zoom_cache.get(zoom)
+    if cached is None or cached[0] is not lh.x.ticks \
+            or cached[1] is not lh.y.ticks:
+        x = scipy.ndimage.zoom(np.sort(lh.x.ticks), zoom=zoom, order=1)
+        y = scipy.ndimage.zoom(np.sort(lh.y.ticks), zoom=zoom, order=1)
+        cached = lh._zoom_cache[zoom] = (lh.x.ticks, lh.y.ticks, x, y)
+    return cached[2], cached[3]
+
+
 def plot(lh: LikelihoodResults,
          *, margin: float = 0.0, n_sigma: Sequence[float] = (1.0, 2.0),
          zoom: float = 5.0, loc: str = 'best', numticks: int = 6,
@@ -37,21 +75,43 @@ def plot(lh: LikelihoodResults,
     ymax = lh.y.max - abs(lh.y.max*margin)
     plt.xlim([xmin, xmax])
     plt.ylim([ymin, ymax])
-    x = scipy.ndimage.zoom(lh.x.ticks, zoom=zoom, order=1)
-    y = scipy.ndimage.zoom(lh.y.ticks, zoom=zoom, order=1)
+    x, y = _zoomed_axes(lh, zoom)
+    levels = [delta_chi2(n, dof=2) for n in n_sigma]
+    N = len(levels)
+    alphas = np.asarray([max(1-n/(N+1), 0) for n in range(1, N+1)],
+                        dtype=np.float32)
+    colors = _PALETTE if palette is pastel else np.asarray(
+        palette, dtype=np.float32)
+    colors = colors[:, :3]
     proxies = []
     legends = []
-    for i, l in enumerate(lh.likelihoods):
-        chi = -2 * (l.data - l.max)
-        levels = [delta_chi2(n, dof=2) for n in n_sigma]
-        N = len(levels)
-        z = scipy.ndimage.zoom(chi, zoom=zoom, order=2)
-        colori = palette[i % len(palette)]
-        colorf = [colori + (max(1-n/(N+1), 0),) for n in range(1, N+1)]
+    values = lh.values
+    maxes = values.max(axis=(1, 2))
+    chis = -2 * (values - maxes[:, np.newaxis, np.newaxis])
+    xorder, xticks = _sorted_ticks(lh.x)
+    yorder, yticks = _sorted_ticks(lh.y)
+    chis = chis[:, yorder[:, np.newaxis], xorder]
+    # Quadratic splines, unless there are too few ticks.
+    # The first coordinate of the spline is y, the second x
+    kx = min(2, len(yticks) - 1)
+    ky = min(2, len(xticks) - 1)
+
+    def interpolate(chi: np.ndarray) -> np.ndarray:
+        spl = RectBivariateSpline(yticks, xticks, chi, kx=kx, ky=ky)
+        return spl(y, x)
+
+    # The interpolation runs in compiled code and can be done in parallel,
+    # but matplotlib is not thread-safe, so the drawing stays serial
+    with ThreadPoolExecutor() as ex:
+        zs = list(ex.map(interpolate, chis))
+    for i, (l, z) in enumerate(zip(lh.likelihoods, zs)):
+        rgb = colors[i % len(colors)]
+        colori = tuple(rgb.tolist())
+        colorf = np.column_stack([np.tile(rgb, (N, 1)), alphas]).tolist()
         ax.contourf(x, y, z, levels=[0, ]+levels, colors=colorf)
         ax.contour(x, y, z, levels=levels, colors=[colori])
         proxies.append(plt.Rectangle(
-            (0, 0), 1, 1, fc=colori + (1-1/(N+1),)))
+            (0, 0), 1, 1, fc=colorf[0]))
         legends.append(l.tex_label)
     plt.xlabel(lh.x.tex_label, fontsize=18)
     plt.ylabel(lh.y.tex_label, fontsize=18)
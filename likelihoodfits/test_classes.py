@@ -1,8 +1,17 @@
 import likelihoodfits
 import numpy as np
 from io import BytesIO
+from pathlib import Path
+import h5py
 import pytest
 
+EXAMPLE_HDF5 = Path(__file__).parent.parent / 'examples' / 'data' / \
+    'lqU1_simple.hdf5'
+
+
+def _product_fun(x, y):
+    return {'testnew': x*y}
+
 
 class TestAxis:
     ax = likelihoodfits.Axis([2.0, 3.0, 7.0, 5.0], 'test', 't')
@@ -23,6 +32,24 @@ class TestAxis:
         with pytest.raises(IndexError):
             self.ax[20]
 
+    def test_readonly_ticks(self):
+        with pytest.raises(ValueError):
+            self.ax.ticks[0] = 10.0
+
+    def test_set_ticks(self):
+        ax = likelihoodfits.Axis([2.0, 3.0], 'test', 't')
+        ax.ticks = [5.0, 6.0, 7.0]
+        assert isinstance(ax.ticks, np.ndarray)
+        assert ax.len == 3
+        assert ax.max == 7.0
+        assert ax.min == 5.0
+
+    def test_eq(self):
+        assert likelihoodfits.Axis([0.1, 0.2], 'x', 'x') == \
+            likelihoodfits.Axis([0.1, 0.2], 'x', 'x')
+        assert likelihoodfits.Axis([0.1, 0.2], 'x', 'x') != \
+            likelihoodfits.Axis([0.1, 0.3], 'x', 'x')
+
 
 class TestLikelihoodValues:
     lhv = likelihoodfits.LikelihoodValues(
@@ -35,40 +62,94 @@ class TestLikelihoodValues:
         self.lhv.data[2, 3] = 27.5
         assert self.lhv.max == 27.5
 
+    def test_update_max(self):
+        lhv = likelihoodfits.LikelihoodValues(
+            np.zeros((5, 5), dtype=np.float32), 'test', 'test')
+        assert lhv.max == 0.0
+        lhv.update(1, 2, 3.5)
+        assert lhv.max == 3.5
+        lhv.update(4, 0, 1.5)
+        assert lhv.max == 3.5
+        lhv.update(1, 2, -1.0)
+        assert lhv.max == 1.5
+        lhv.data[0, 0] = 8.0
+        lhv.invalidate_max()
+        assert lhv.max == 8.0
+
+
+@pytest.mark.parametrize('shape, chunks', [((50, 50), (50, 50)),
+                                           ((400, 300), (200, 150)),
+                                           ((3, 1000, 1000), (1, 125, 250))])
+def test_chunk_heuristic(shape, chunks):
+    assert likelihoodfits.classes._chunk_heuristic(shape) == chunks
+
 
 class TestLikelihoodResults:
     x = likelihoodfits.Axis([0, 1, 2, 3, 4], 'x', 'x')
     y = likelihoodfits.Axis([6, 7, 8, 9, 10], 'y', 'y')
+    y_short = likelihoodfits.Axis([6, 7, 8], 'y', 'y')
 
     def test_numdata(self):
         lhr = likelihoodfits.LikelihoodResults(self.x, self.y)
         assert lhr.numdata == 25
 
     def test_add_likelihood(self):
-        lhr = likelihoodfits.LikelihoodResults(self.x, self.y)
+        lhr = likelihoodfits.LikelihoodResults(self.x, self.y_short)
         lh_rand = likelihoodfits.LikelihoodValues(
-            np.random.random((5, 5)), 'random', 'rnd')
+            np.random.random((3, 5)), 'random', 'rnd')
         lhr.add_likelihood(lh_rand)
         assert lhr.likelihoods[-1].likelihood == 'random'
 
     def test_wrong_add_likelihood(self):
-        lhr = likelihoodfits.LikelihoodResults(self.x, self.y)
+        lhr = likelihoodfits.LikelihoodResults(self.x, self.y_short)
         lh_rand = likelihoodfits.LikelihoodValues(
-            np.random.random((6, 5)), 'random', 'rnd')
+            np.random.random((5, 3)), 'random', 'rnd')
         with pytest.raises(ValueError):
             lhr.add_likelihood(lh_rand)
 
+    def test_non_square(self):
+        lhr = likelihoodfits.LikelihoodResults(self.x, self.y_short)
+        def fun(x, y): return {'testnew': x*y}
+        lhr.new_likelihood('testnew', 'testnew')
+        assert lhr.likelihoods[0].shape == (3, 5)
+        lhr.calculate_all(fun)
+        with BytesIO() as file:
+            lhr.to_hdf5(file)
+            lh2 = likelihoodfits.LikelihoodResults.from_hdf5(file)
+        assert lh2.likelihoods[0].data[2, 4] == 32
+
     def test_new_likelihood(self):
         lhr = likelihoodfits.LikelihoodResults(self.x, self.y)
         lhr.new_likelihood('testnew', 'testnew')
         assert lhr.likelihoods[-1].likelihood == 'testnew'
 
+    def test_values(self):
+        lhr = likelihoodfits.LikelihoodResults(self.x, self.y)
+        lhr.new_likelihood('first', 'first')
+        lhr.new_likelihood('second', 'second')
+        lhr.likelihoods[1].data[2, 3] = 5.0
+        assert lhr.values.shape == (2, 5, 5)
+        assert lhr.values[1, 2, 3] == 5.0
+        lhr.likelihoods.reverse()
+        assert lhr.values[0, 2, 3] == 5.0
+        lhr.values[0, 2, 3] = 7.0
+        assert lhr.likelihoods[0].data[2, 3] == 7.0
+
     def test_calculate_point(self):
         lhr = likelihoodfits.LikelihoodResults(self.x, self.y)
         def fun(x, y): return {'testnew': x*y}
         lhr.new_likelihood('testnew', 'testnew')
         lhr.calculate_point(fun, 3, 1)
-        assert lhr.likelihoods[-1].data[1, 3] == 21  # Está transpuesto
+        assert lhr.likelihoods[-1].data[1, 3] == 21
+
+    def test_calculate_point_inf(self):
+        lhr = likelihoodfits.LikelihoodResults(self.x, self.y)
+        def fun(x, y): return {'testinf': -np.inf, 'testnan': np.nan}
+        lhr.new_likelihood('testinf', 'testinf')
+        lhr.new_likelihood('testnan', 'testnan')
+        lhr.calculate_point(fun, 3, 1)
+        assert lhr.likelihoods[0].data[1, 3] == -200.0
+        assert np.isnan(lhr.likelihoods[1].data[1, 3])
 
     def test_calculate_all(self):
         lhr = likelihoodfits.LikelihoodResults(self.x, self.y)
@@ -77,6 +158,124 @@ class TestLikelihoodResults:
         lhr.calculate_all(fun)
         assert lhr.likelihoods[-1].data[2, 3] == 24
 
+    def test_calculate_all_inf(self):
+        lhr = likelihoodfits.LikelihoodResults(self.x, self.y)
+        def fun(x, y): return {'testnew': x*y, 'testinf': np.inf if x > 2 else x}
+        lhr.new_likelihood('testnew', 'testnew')
+        lhr.new_likelihood('testinf', 'testinf')
+        lhr.calculate_all(fun)
+        assert lhr.likelihoods[0].data[2, 3] == 24
+        assert lhr.likelihoods[0].max == 40
+        assert lhr.likelihoods[1].data[2, 3] == -200.0
+        assert lhr.likelihoods[1].data[2, 1] == 1
+
+    def test_calculate_all_batched(self):
+        lhr = likelihoodfits.LikelihoodResults(self.x, self.y)
+        def fun_row(x, ys): return {'testnew': x*ys, 'testinf': -np.inf}
+        lhr.new_likelihood('testnew', 'testnew')
+        lhr.new_likelihood('testinf', 'testinf')
+        lhr.calculate_all_batched(fun_row)
+        assert lhr.likelihoods[0].data[2, 3] == 24
+        assert lhr.likelihoods[1].data[2, 3] == -200.0
+
+    def test_calculate_all_rowwise(self):
+        lhr = likelihoodfits.LikelihoodResults(self.x, self.y)
+        def fun(x, y): return {'testnew': x*y, 'testold': x+y}
+        lhr.new_likelihood('testnew', 'testnew')
+        lhr.calculate_all_batched(likelihoodfits.rowwise(fun))
+        assert lhr.likelihoods[0].data[2, 3] == 24
+
+    def test_rowwise_missing_key(self):
+        def fun(x, y): return {'testnew': x*y} if y < 8 else {}
+        with pytest.raises(ValueError):
+            likelihoodfits.rowwise(fun)(2.0, np.array([6.0, 7.0, 8.0]))
+
+    def test_calculate_all_vectorized(self):
+        lhr = likelihoodfits.LikelihoodResults(self.x, self.y)
+        def fun(x, y): return {'testnew': x*y,
+                               'testinf': np.where(x > 2, -np.inf, x)}
+        lhr.new_likelihood('testnew', 'testnew')
+        lhr.new_likelihood('testinf', 'testinf')
+        lhr.calculate_all_vectorized(fun)
+        assert lhr.likelihoods[0].data[2, 3] == 24
+        assert lhr.likelihoods[1].data[2, 3] == -200.0
+        assert lhr.likelihoods[1].data[2, 1] == 1
+
+    @pytest.mark.parametrize('nworkers', [1, 2])
+    def test_calculate_all_parallel(self, nworkers):
+        lhr = likelihoodfits.LikelihoodResults(self.x, self.y)
+        lhr.new_likelihood('testnew', 'testnew')
+        points = list(lhr.calculate_all_parallel(_product_fun, nworkers))
+        assert len(points) == lhr.numdata
+        assert lhr.likelihoods[-1].data[2, 3] == 24
+
+    def test_calculate_all_numba(self):
+        numba = pytest.importorskip('numba')
+        lhr = likelihoodfits.LikelihoodResults(self.x, self.y)
+        @numba.njit
+        def fun(x, y): return (x*y, -np.inf)
+        lhr.new_likelihood('testnew', 'testnew')
+        lhr.new_likelihood('testinf', 'testinf')
+        lhr.calculate_all_numba(fun)
+        assert lhr.likelihoods[0].data[2, 3] == 24
+        assert lhr.likelihoods[1].data[2, 3] == -200.0
+
+    def test_calculate_max(self):
+        lhr = likelihoodfits.LikelihoodResults(self.x, self.y)
+        def fun(x, y): return {'testnew': x*y}
+        lhr.new_likelihood('testnew', 'testnew')
+        assert lhr.likelihoods[0].max == 0
+        lhr.calculate_point(fun, 3, 1)
+        assert lhr.likelihoods[0].max == 21
+        lhr.calculate_all_vectorized(fun)
+        assert lhr.likelihoods[0].max == 40
+
+    def test_calculate_all_parallel_break(self, monkeypatch):
+        calls = []
+        shutdown = likelihoodfits.classes.ProcessPoolExecutor.shutdown
+        def spy(pool, *args, **kwargs):
+            calls.append(kwargs)
+            return shutdown(pool, *args, **kwargs)
+        monkeypatch.setattr(likelihoodfits.classes.ProcessPoolExecutor,
+                            'shutdown', spy)
+        lhr = likelihoodfits.LikelihoodResults(self.x, self.y)
+        lhr.new_likelihood('testnew', 'testnew')
+        gen = lhr.calculate_all_parallel(_product_fun, 2)
+        next(gen)
+        assert calls == []
+        gen.close()
+        assert calls[0] == {'cancel_futures': True}
+
+    def test_calculate_all_numba_wrong_length(self):
+        numba = pytest.importorskip('numba')
+        lhr = likelihoodfits.LikelihoodResults(self.x, self.y)
+        @numba.njit
+        def fun(x, y): return (x*y,)
+        lhr.new_likelihood('first', 'first')
+        lhr.new_likelihood('second', 'second')
+        with pytest.raises(ValueError):
+            lhr.calculate_all_numba(fun)
+
+    def test_calculate_all_raises_max(self):
+        lhr = likelihoodfits.LikelihoodResults(self.x, self.y)
+        def fun(x, y): return {'testnew': 0.0} if x == 0 else {}
+        lhr.new_likelihood('testnew', 'testnew')
+        lhr.likelihoods[0].update(0, 0, 100.0)
+        assert lhr.likelihoods[0].max == 100.0
+        with pytest.raises(KeyError):
+            lhr.calculate_all(fun)
+        assert lhr.likelihoods[0].max == 0.0
+
+    def test_calculate_all_batched_raises_max(self):
+        lhr = likelihoodfits.LikelihoodResults(self.x, self.y)
+        def fun_row(x, ys): return {'testnew': ys*0} if x == 0 else {}
+        lhr.new_likelihood('testnew', 'testnew')
+        lhr.likelihoods[0].update(0, 0, 100.0)
+        assert lhr.likelihoods[0].max == 100.0
+        with pytest.raises(KeyError):
+            lhr.calculate_all_batched(fun_row)
+        assert lhr.likelihoods[0].max == 0.0
+
     def test_calculate_missing_lh(self):
         lhr = likelihoodfits.LikelihoodResults(self.x, self.y)
         def fun(x, y): return {'testold': x*y}
@@ -99,6 +298,97 @@ class TestLikelihoodResults:
             saved = True
         assert saved
 
+    @pytest.mark.parametrize('compression', ['lzf', 'gzip', None])
+    def test_load_compressed(self, compression):
+        lhr = likelihoodfits.LikelihoodResults(self.x, self.y)
+        def fun(x, y): return {'testnew': x*y}
+        lhr.new_likelihood('testnew', 'testnew')
+        lhr.calculate_all(fun)
+        with BytesIO() as file:
+            lhr.to_hdf5(file, compression=compression)
+            lh2 = likelihoodfits.LikelihoodResults.from_hdf5(file)
+        assert np.array_equal(lh2.likelihoods[0].data, lhr.likelihoods[0].data)
+
+    @pytest.mark.parametrize('lsd', [1, None])
+    def test_load_lsd(self, lsd):
+        lhr = likelihoodfits.LikelihoodResults(self.x, self.y)
+        def fun(x, y): return {'testnew': x*y + 0.123}
+        lhr.new_likelihood('testnew', 'testnew')
+        lhr.calculate_all(fun)
+        with BytesIO() as file:
+            lhr.to_hdf5(file, lsd=lsd)
+            lh2 = likelihoodfits.LikelihoodResults.from_hdf5(file)
+        # With lsd=1 the values are rounded to multiples of 1/16
+        expected = np.float32(24.125) if lsd == 1 else np.float32(24.123)
+        assert lh2.likelihoods[0].data[2, 3] == expected
+
+    def test_save_lsd_smaller(self):
+        x = likelihoodfits.Axis(np.linspace(0, 1, 200), 'x', 'x')
+        y = likelihoodfits.Axis(np.linspace(0, 1, 200), 'y', 'y')
+        lhr = likelihoodfits.LikelihoodResults(x, y)
+        def fun(x, y): return {'testnew': 10*np.sin(3*x) * np.cos(2*y)}
+        lhr.new_likelihood('testnew', 'testnew')
+        lhr.calculate_all(fun)
+        sizes = {}
+        for lsd in [2, None]:
+            with BytesIO() as file:
+                lhr.to_hdf5(file, lsd=lsd)
+                sizes[lsd] = file.getbuffer().nbytes
+        assert sizes[2] < 0.8*sizes[None]
+
+    def test_load_order(self):
+        lhr = likelihoodfits.LikelihoodResults(self.x, self.y)
+        def fun(x, y): return {'first': x*y, 'second': x+y}
+        lhr.new_likelihood('first', 'first')
+        lhr.new_likelihood('second', r'$\chi$')
+        lhr.calculate_all(fun)
+        lhr.likelihoods[0].order = 2
+        with BytesIO() as file:
+            lhr.to_hdf5(file)
+            lh2 = likelihoodfits.LikelihoodResults.from_hdf5(file)
+        assert [l.likelihood for l in lh2.likelihoods] == ['second', 'first']
+        assert lh2.likelihoods[0].tex_label == r'$\chi$'
+        assert lh2.likelihoods[0].data[2, 3] == 11
+        assert lh2.values[1, 2, 3] == 24
+
+    def test_load_empty(self):
+        lhr = likelihoodfits.LikelihoodResults(self.x, self.y)
+        with BytesIO() as file:
+            lhr.to_hdf5(file)
+            lh2 = likelihoodfits.LikelihoodResults.from_hdf5(file)
+        assert lh2.likelihoods == []
+
+    def test_load_legacy(self):
+        # Layout written by older versions, with a group per likelihood
+        with BytesIO() as file:
+            with h5py.File(file, 'w') as f:
+                axes = f.create_group('axes')
+                axes.create_dataset('x', data=self.x.ticks, dtype='f4')
+                axes.create_dataset('y', data=self.y.ticks, dtype='f4')
+                axes.attrs.update({'x name': 'x', 'x tex': 'x',
+                                   'y name': 'y', 'y tex': 'y'})
+                likelihoods = f.create_group('likelihoods')
+                for name, order in [('a', 2), ('b', 0), ('c', 1)]:
+                    gr = likelihoods.create_group(name)
+                    gr.attrs.update({'tex': name.upper(), 'order': order})
+                    gr.create_dataset('values', dtype='f4',
+                                      data=np.full((5, 5), order))
+            lh2 = likelihoodfits.LikelihoodResults.from_hdf5(file)
+        assert [l.likelihood for l in lh2.likelihoods] == ['b', 'c', 'a']
+        assert [l.tex_label for l in lh2.likelihoods] == ['B', 'C', 'A']
+        assert np.array_equal(lh2.values[:, 2, 3], [0, 1, 2])
+
+    @pytest.mark.skipif(not EXAMPLE_HDF5.exists(),
+                        reason='example data not available')
+    def test_load_example(self):
+        lh = likelihoodfits.LikelihoodResults.from_hdf5(EXAMPLE_HDF5)
+        assert [l.likelihood for l in lh.likelihoods] == [
+            'likelihood_lfv.yaml', 'likelihood_lfu_fcnc.yaml',
+            'likelihood_rd_rds.yaml', 'global']
+        assert [l.order for l in lh.likelihoods] == [0, 1, 2, 3]
+        assert lh.values.shape == (4, 50, 50)
+        assert lh.x.name == 'x1'
+
     def test_load(self):
         lhr = likelihoodfits.LikelihoodResults(self.x, self.y)
         def fun(x, y): return {'testnew': x*y}
@@ -0,0 +1,86 @@
+import matplotlib.pyplot as plt
+import numpy as np
+import scipy.stats
+import pytest
+import likelihoodfits
+from likelihoodfits.plot import delta_chi2, plot
+
+
+@pytest.mark.parametrize('nsigma', [0.5, 1.0, 2.0, 3.0, 5.0, 40.0])
+def test_delta_chi2_2dof(nsigma):
+    cl = (scipy.stats.norm.cdf(nsigma)-0.5)*2
+    assert delta_chi2(nsigma, 2) == pytest.approx(
+        scipy.stats.chi2(2).ppf(cl), rel=1e-6)
+
+
+def test_delta_chi2():
+    assert delta_chi2(2.0, 1) == 4.0
+    assert delta_chi2(1.0, 2) == pytest.approx(2.2957, abs=1e-4)
+
+
+def _results(x=np.linspace(-1, 1, 5), y=np.linspace(0, 2, 4), nlh=1):
+    lhr = likelihoodfits.LikelihoodResults(
+        likelihoodfits.Axis(x, 'x', 'x'), likelihoodfits.Axis(y, 'y', 'y'))
+    for n in range(nlh):
+        lhr.new_likelihood(f'lh{n}', f'lh{n}')
+    lhr.calculate_all_vectorized(
+        lambda x, y: {f'lh{n}': -x**2 - (y-1)**2 - n for n in range(nlh)})
+    return lhr
+
+
+@pytest.mark.parametrize('nlh', [1, 3])
+def test_plot(nlh):
+    fig = plot(_results(nlh=nlh), n_sigma=(1, 2, 3))
+    legend = fig.axes[0].get_legend()
+    assert [t.get_text() for t in legend.get_texts()] == \
+        [f'lh{n}' for n in range(nlh)]
+    plt.close(fig)
+
+
+def test_plot_palette_rgba():
+    palette = [(1.0, 0.0, 0.0, 1.0), (0.0, 0.0, 1.0, 0.5)]
+    fig = plot(_results(nlh=3), palette=palette)
+    legend = fig.axes[0].get_legend()
+    # Renamed in matplotlib 3.7
+    handles = getattr(legend, 'legend_handles', None) or legend.legendHandles
+    assert [tuple(h.get_facecolor()[:3]) for h in handles] == \
+        [(1.0, 0.0, 0.0), (0.0, 0.0, 1.0), (1.0, 0.0, 0.0)]
+    plt.close(fig)
+
+
+def test_plot_zoom_cache():
+    lhr = _results(nlh=2)
+    plt.close(plot(lhr, zoom=4.0))
+    cached = lhr._zoom_cache[4.0]
+    plt.close(plot(lhr, zoom=4.0))
+    assert lhr._zoom_cache[4.0] is cached
+    assert list(lhr._zoom_cache) == [4.0]
+    lhr.x.ticks = np.linspace(-2, 2, 5)
+    plt.close(plot(lhr, zoom=4.0))
+    assert lhr._zoom_cache[4.0] is not cached
+    assert lhr._zoom_cache[4.0][2].max() == pytest.approx(2.0)
+
+
+def test_plot_empty():
+    fig = plot(_results(nlh=0))
+    assert len(fig.axes[0].collections) == 0
+    plt.close(fig)
+
+
+@pytest.mark.parametrize('x', [np.linspace(1, -1, 5),
+                               [0.5, -1.0, 1.0, 0.0, -0.5]])
+def test_plot_unsorted_ticks(x):
+    lhr = _results(x=x)
+    fig = plot(lhr)
+    ref = plot(_results())
+    z = fig.axes[0].collections[0].get_paths()[0].vertices
+    zref = ref.axes[0].collections[0].get_paths()[0].vertices
+    assert np.allclose(np.sort(z, axis=0), np.sort(zref, axis=0))
+    plt.close(fig)
+    plt.close(ref)
+
+
+def test_plot_repeated_ticks():
+    with pytest.raises(ValueError):
+        plot(_results(x=[0.0, 0.0, 1.0, 2.0, 3.0]))
+    plt.close('all')